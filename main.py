@@ -1,10 +1,13 @@
 import os
 import sqlite3
-from dataclasses import dataclass
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import NamedTuple
 
-# Data class for a site option entity
-@dataclass
-class SiteOption:
+# Named tuple for a site option entity
+# A tuple has no per-instance __dict__, which keeps the many instances created by fetches small
+class SiteOption(NamedTuple):
 	site_id: int
 	version_id: int
 	brand: str
@@ -12,279 +15,728 @@ class SiteOption:
 	dp_id: int
 	on_site: bool
 
+# SQL statements used by the helpers below
+# These are kept as module constants so every call hands sqlite3 the same text, which lets its statement cache
+# reuse the compiled statement instead of parsing and planning the SQL again.
+# Parameters are positional, statements that use a value more than once refer to it by number (?1, ?2, ...)
+
+# "Delete" the rows a fill would affect by writing a deleted row for each item in the branch version
+# ROW_NUMBER() picks out the latest version of each item in one walk of the primary key, which is already in
+# (brand, pn, dp_id, version_id DESC) order, so there's no grouping or self-join. Items whose latest row is already deleted are skipped.
+# The predicates are filled in based on which of brand/pn/dp_id the fill is over, see SQL_FILL_SITE_OPTIONS_BY_KEYS below
+SQL_FILL_SITE_OPTIONS = '''
+INSERT INTO site_options(version_id, site_id, brand, pn, dp_id, on_site, deleted) 
+SELECT ?1, site_id, brand, pn, dp_id, 0, 1
+FROM (
+	SELECT site_id, brand, pn, dp_id, deleted, 
+		ROW_NUMBER() OVER (PARTITION BY brand, pn, dp_id ORDER BY version_id DESC) AS rn
+	FROM site_options
+	WHERE {predicates}
+)
+-- This WHERE also stops SQLite parsing the ON CONFLICT as part of the FROM clause
+WHERE rn=1 AND deleted=0
+ON CONFLICT(site_id, brand, pn, dp_id, version_id) DO UPDATE SET on_site=excluded.on_site, deleted=excluded.deleted;
+'''
+
+# The fill statement for each combination of brand/pn/dp_id being set, keyed on (bool(brand), bool(pn), bool(dp_id))
+# These are built once so the text handed to sqlite3 is the same every call for its statement cache.
+# Each combination gets its own statement rather than one with "(? IS NULL OR brand=?)" style guards, since SQLite can't
+# seek on a guarded column, which turns an item fill into a scan of the whole site.
+# Takes (branch_version_id, site_id) followed by whichever of brand/pn/dp_id are set.
+SQL_FILL_SITE_OPTIONS_BY_KEYS = {
+	(brand, pn, dp_id): SQL_FILL_SITE_OPTIONS.format(predicates="site_id=?2 AND version_id<=?1"
+		+ (" AND brand=?" if brand else "")
+		+ (" AND pn=?" if pn else "")
+		+ (" AND dp_id=?" if dp_id else ""))
+	for brand in (False, True) for pn in (False, True) for dp_id in (False, True)
+}
+
+# Store a site option or fill row
+# This is an upsert, so storing over a row already in the branch version updates it in place
+# rather than deleting it and inserting a new one the way INSERT OR REPLACE would.
+# Storing over a row deleted earlier in the same branch version un-deletes it, since excluded.deleted is the default 0.
+SQL_STORE_SITE_OPTION = '''
+INSERT INTO site_options(site_id, version_id, brand, pn, dp_id, on_site) 
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(site_id, brand, pn, dp_id, version_id) DO UPDATE SET on_site=excluded.on_site, deleted=excluded.deleted; 
+'''
+
+# Store a changelog entry for a change to a site option
+SQL_STORE_SITE_CHANGE = '''
+INSERT INTO site_changes(site_id, version_id, description) 
+VALUES (?, ?, ?)
+'''
+
+# Bits for the fill levels a site has ever stored, see get_site_fill_levels
+FILL_ITEM  = 1 # Fill for all options on an item (dp_id=0)
+FILL_BRAND = 2 # Fill for all items in a brand (pn='*', dp_id=0)
+FILL_SITE  = 4 # Default fill value for the site (brand='*', pn='*', dp_id=0)
+
+# Use a coalesce'd select query to get the on_site value for the site option, taking into account fills
+# This reads the live values kept in site_options_current, so each probe is a single primary key lookup
+# with no version history to search through.
+# SQLite's COALESCE stops at the first non-null argument, so the fill probes are only run when the more specific ones miss.
+# Deleted items have no row in site_options_current, so the lookup falls through to the next fill.
+# The fill probes are filled in based on which fill levels the site has, see SQL_FETCH_SITE_OPTION_BY_FILLS below
+SQL_FETCH_SITE_OPTION = '''
+SELECT
+	-- Query most specific to least specific, looking for a result 
+	COALESCE(
+		-- Item specific check
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?2 AND pn=?3   AND dp_id=?4),{fills}
+		-- Default fallback value
+		TRUE);
+'''
+SQL_FETCH_SITE_OPTION_FILL_PROBES = (
+	(FILL_ITEM, '''
+		-- Fill for all options on item (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?2 AND pn=?3   AND dp_id=0),'''),
+	(FILL_BRAND, '''
+		-- FIll for all items in brand (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?2 AND pn=\'*\' AND dp_id=0),'''),
+	(FILL_SITE, '''
+		-- Default fill value for the site
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=\'*\'  AND pn=\'*\' AND dp_id=0),'''),
+)
+
+# The fetch statement for each combination of fill levels, keyed on the site's FILL_* bits
+# A site that has never stored a fill at some level can't have a value there, so its probe is left out.
+SQL_FETCH_SITE_OPTION_BY_FILLS = {
+	fill_levels: SQL_FETCH_SITE_OPTION.format(fills="".join(
+		probe for level, probe in SQL_FETCH_SITE_OPTION_FILL_PROBES if fill_levels & level
+	))
+	for fill_levels in range((FILL_ITEM | FILL_BRAND | FILL_SITE) + 1)
+}
+
+# Get and add to the FILL_* levels a site has ever stored, kept in the sites table by the stores
+# Levels are never removed, so they are a superset of the ones live at the trunk in any version.
+SQL_GET_SITE_FILL_LEVELS = '''SELECT fill_levels FROM sites WHERE site_id=?'''
+SQL_ADD_SITE_FILL_LEVEL = '''UPDATE sites SET fill_levels=fill_levels | ? WHERE site_id=?'''
+
+# Key counts the batched fetches bind per query, each batch is padded out to the smallest of these it fits in
+# Each size is its own statement, so this keeps them to a couple of entries in the statement cache
+# without a small fetch having to bind a full batch.
+FETCH_BATCH_SIZES = (8, 32)
+
+# Same fill resolution as above, for several options on one item in a single statement
+# The dp_ids are passed in as a VALUES list starting at ?6, only the item specific check depends on the dp_id.
+# The fill checks don't, so SQLite only has to run them once for the whole statement.
+# Each dp_id is numbered, the ones past the count in ?5 only pad out the batch and are skipped.
+SQL_FETCH_SITE_OPTIONS_MANY = '''
+WITH _keys(n, dp_id) AS (VALUES {keys})
+SELECT ?1, ?2, ?3, ?4, k.dp_id,
+	COALESCE(
+		-- Item specific check
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?3 AND pn=?4   AND dp_id=k.dp_id),
+		-- Fill for all options on item (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?3 AND pn=?4   AND dp_id=0),
+		-- FIll for all items in brand (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=?3 AND pn=\'*\' AND dp_id=0),
+		-- Default fill value for the site
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=\'*\'  AND pn=\'*\' AND dp_id=0),
+		-- Default fallback value
+		TRUE)
+FROM _keys k
+WHERE k.n <= ?5;
+'''
+
+# The many-fetch statement for each of FETCH_BATCH_SIZES, keyed on the number of dp_ids it binds
+SQL_FETCH_SITE_OPTIONS_MANY_BY_SIZE = {
+	size: SQL_FETCH_SITE_OPTIONS_MANY.format(keys=", ".join(f"({n + 1}, ?{6 + n})" for n in range(size)))
+	for size in FETCH_BATCH_SIZES
+}
+
+# Same fill resolution again, for any mix of items in a single statement
+# The (brand, pn, dp_id) keys are passed in as a VALUES list starting at ?3. Unlike the query above every probe depends on the key,
+# so all of them are run for each row. Each key is numbered, the ones past the key count in ?2 only pad out the batch and are skipped.
+SQL_FETCH_SITE_OPTIONS_BULK = '''
+WITH _keys(n, brand, pn, dp_id) AS (VALUES {keys})
+SELECT k.brand, k.pn, k.dp_id,
+	COALESCE(
+		-- Item specific check
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=k.brand AND pn=k.pn   AND dp_id=k.dp_id),
+		-- Fill for all options on item (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=k.brand AND pn=k.pn   AND dp_id=0),
+		-- FIll for all items in brand (site-specific)
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=k.brand AND pn=\'*\'  AND dp_id=0),
+		-- Default fill value for the site
+		(SELECT on_site FROM site_options_current WHERE site_id=?1 AND brand=\'*\'    AND pn=\'*\'  AND dp_id=0),
+		-- Default fallback value
+		TRUE)
+FROM _keys k
+WHERE k.n <= ?2;
+'''
+
+# The bulk fetch statement for each of FETCH_BATCH_SIZES, keyed on the number of keys it binds
+SQL_FETCH_SITE_OPTIONS_BULK_BY_SIZE = {
+	size: SQL_FETCH_SITE_OPTIONS_BULK.format(keys=", ".join(
+		f"({n + 1}, ?{3 + 3 * n}, ?{4 + 3 * n}, ?{5 + 3 * n})" for n in range(size)
+	))
+	for size in FETCH_BATCH_SIZES
+}
+
+# Create a site entry with default values
+# Re-creating a site resets its versions but keeps its fill levels, since the options stored under it are kept too
+SQL_CREATE_SITE = '''
+INSERT INTO sites(site_id, trunk_version_id, branch_version_id) VALUES (?, 0, 1) 
+ON CONFLICT(site_id) DO UPDATE SET trunk_version_id=0, branch_version_id=1; 
+'''
+
+# Get the trunk and branch IDs for a site
+SQL_GET_SITE_TRUNK_VERSION = '''SELECT trunk_version_id FROM sites WHERE site_id=?'''
+SQL_GET_SITE_BRANCH_VERSION = '''SELECT branch_version_id FROM sites WHERE site_id=?'''
+
+# Get the changelog entries for a version, oldest first
+# Only the printed columns are selected. Ordering by rowid keeps entries in the order they were written,
+# and costs no sort since idx_changelogs entries with the same site_id and version_id are already in rowid order.
+SQL_GET_CHANGELOG = '''
+SELECT created_at, description FROM site_changes WHERE site_id=? AND version_id=? ORDER BY rowid;
+'''
+
+# Swap the trunk version for the branch version, increment the branch version
+# The new versions are worked out from the cached branch version and bound directly
+SQL_PUBLISH_SITE = '''
+UPDATE sites SET 
+	trunk_version_id =?, 
+	branch_version_id=? 
+WHERE site_id=?;
+'''
+
+# Bring site_options_current up to date with a newly published version
+# Only the rows written in that version can have changed, and they are now the latest for their items,
+# so the live rows are upserted and the deleted ones removed. Takes (site_id, version_id) as parameters.
+# Both read the version's rows through idx_site_options_versions, the primary key can only seek on site_id here
+# since version_id is its last column. INDEXED BY makes the statement fail to prepare rather than fall back to a scan.
+SQL_UPDATE_CURRENT_SITE_OPTIONS = '''
+INSERT INTO site_options_current(site_id, brand, pn, dp_id, on_site) 
+SELECT site_id, brand, pn, dp_id, on_site FROM site_options INDEXED BY idx_site_options_versions 
+WHERE site_id=?1 AND version_id=?2 AND deleted=0
+ON CONFLICT(site_id, brand, pn, dp_id) DO UPDATE SET on_site=excluded.on_site;
+'''
+SQL_DELETE_CURRENT_SITE_OPTIONS = '''
+DELETE FROM site_options_current 
+WHERE site_id=?1 AND (brand, pn, dp_id) IN (
+	SELECT brand, pn, dp_id FROM site_options INDEXED BY idx_site_options_versions 
+	WHERE site_id=?1 AND version_id=?2 AND deleted=1);
+'''
+
+# Clear a site's live values, used when the site is (re)created at trunk version 0 where nothing is published yet
+SQL_CLEAR_CURRENT_SITE_OPTIONS = '''
+DELETE FROM site_options_current WHERE site_id=?;
+'''
+
+# Store a changelog entry for a publish
+SQL_STORE_PUBLISH_CHANGE = '''
+INSERT INTO site_changes(site_id, version_id, description, is_publish) 
+VALUES (?, ?, ?, true)
+'''
+
+# Rollback the site data by writing every item's value as of the version being rolled back to into the branch version
+# Takes (site_id, to_version_id, branch_version_id) as parameters
+# Items that didn't exist (or were deleted) at that version are written as deleted rows in the new version.
+# The upsert also overwrites any pending changes in the branch version, so they don't need clearing out first.
+# The value is looked up in a MATERIALIZED CTE since it's used twice below, as a plain subquery SQLite would flatten it
+# and run the lookup once for each use.
+SQL_ROLLBACK_SITE = '''
+WITH live AS MATERIALIZED (
+	-- The value live at the version being rolled back to, null if there isn't one
+	SELECT k.brand, k.pn, k.dp_id,
+		(SELECT CASE WHEN o.deleted=0 THEN o.on_site END FROM site_options o 
+			WHERE o.site_id=?1 AND o.brand=k.brand AND o.pn=k.pn AND o.dp_id=k.dp_id AND o.version_id<=?2 
+			ORDER BY o.version_id DESC LIMIT 1) AS on_site
+	FROM (SELECT DISTINCT brand, pn, dp_id FROM site_options WHERE site_id=?1) k
+)
+INSERT INTO site_options(version_id, site_id, brand, pn, dp_id, on_site, deleted) 
+SELECT ?3, ?1, brand, pn, dp_id, COALESCE(on_site, 0), on_site IS NULL
+FROM live
+WHERE true
+ON CONFLICT(site_id, brand, pn, dp_id, version_id) DO UPDATE SET on_site=excluded.on_site, deleted=excluded.deleted;
+'''
+
+# Let SQLite refresh the planner statistics for any tables that need it, this is cheap when nothing has changed much
+SQL_OPTIMIZE = "PRAGMA optimize"
+
+# Connection settings applied as soon as the database is opened
+# WAL lets fetches read the trunk while a writer is active, and NORMAL sync only fsyncs the WAL on checkpoints.
+# The rest keeps temp b-trees in memory, reads pages through mmap with a 64MB page cache,
+# and waits on a locked database instead of failing straight away.
+SQL_CONNECTION_PRAGMAS = '''
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA busy_timeout=5000;
+'''
+
+# The database schema, created if not already there
+# The tables are STRICT, so every value is stored as its declared type and a mistyped bind is an error rather than
+# being silently stored as something else.
+SQL_CREATE_TABLES = '''
+-- Create a table to store site data
+CREATE TABLE IF NOT EXISTS sites(
+	-- Lookup columns
+	-- An integer primary key is the rowid itself, so looking up a site is a rowid seek with no separate index
+	site_id integer primary key not null,
+	-- Trunk version number
+	-- This is the "published" version of data
+	trunk_version_id integer default 0,
+	-- Branch version number
+	-- This is the "pending" version of data
+	branch_version_id integer default 1,
+	-- FILL_* bits for the fill levels the site has ever stored, fetches leave out the probes for the others
+	fill_levels integer not null default 0) 
+STRICT;
+
+-- Create a table to store changelog entries
+CREATE TABLE IF NOT EXISTS site_changes(
+	site_id integer not null,
+	version_id integer not null,
+	description text not null,
+	is_publish integer not null default false,
+	-- STRICT tables have no timestamp type, current_timestamp is stored as 'YYYY-MM-DD HH:MM:SS' text
+	created_at text default current_timestamp) 
+STRICT;
+
+-- Create a index for site_changes on site_id and version_id
+-- This can't be the primary key, a version has an entry for each change as well as the publish
+CREATE INDEX IF NOT EXISTS idx_changelogs ON site_changes(site_id, version_id);
+
+-- Create a table to store item option data and fills
+CREATE TABLE IF NOT EXISTS site_options(
+	-- Lookup columns
+	site_id integer not null,    -- Not fillable
+	version_id integer not null, -- Not fillable
+	brand text not null,         -- Fill value = *
+	pn text not null,            -- Fill value = *
+	dp_id integer not null,      -- Fill value = 0
+	-- Data columns
+	-- SQLite doesn't have boolean types
+	on_site integer not null,
+	-- Set on the rows a fill or rollback writes to "delete" an item in a version, on_site is 0 for these
+	-- Lookups into the history skip past deleted rows, so this has to be checked alongside on_site
+	deleted integer not null default 0,
+	-- The primary key is unique over the lookup values.
+	-- This allows the upserts to work and ensure fills don't overlap.
+	-- With version_id last, finding an item's latest version_id <= some version (rollback, fills) is a single seek with no sort.
+	PRIMARY KEY(site_id, brand, pn, dp_id, version_id DESC))
+-- Rows are stored in the primary key b-tree itself, so there is no separate rowid table and index to keep in step
+STRICT, WITHOUT ROWID;
+
+-- Create an index for site_options on the rows written in each version
+-- publish_site reads the rows of the version being published through this, without it that's a scan of the site's whole history.
+-- The primary key columns are part of every index entry on a WITHOUT ROWID table, so brand/pn/dp_id come for free.
+CREATE INDEX IF NOT EXISTS idx_site_options_versions ON site_options(site_id, version_id, deleted);
+
+-- Create a table holding the live (trunk) value of each item option and fill
+-- This is kept up to date by publish_site, so fetches don't have to search the version history.
+-- Items that are deleted at the trunk version don't have a row.
+CREATE TABLE IF NOT EXISTS site_options_current(
+	site_id integer not null,
+	brand text not null,
+	pn text not null,
+	dp_id integer not null,
+	on_site integer not null,
+	PRIMARY KEY(site_id, brand, pn, dp_id))
+STRICT, WITHOUT ROWID;
+'''
+
+# Apply the connection settings, this should be done right after connecting
+def configure_connection(con):
+	con.executescript(SQL_CONNECTION_PRAGMAS)
+
 # Create schema if not already active
+# The whole schema is run as one script, executescript() commits it when done
 def create_tables(con):
-	# Create a table to store site data
-	con.execute('''
-	CREATE TABLE IF NOT EXISTS sites(
-		-- Lookup columns
-		-- ROWID is automatic in SQLite
-		site_id integer not null,
-		-- Trunk version number
-		-- This is the "published" version of data
-		trunk_version_id integer default 0,
-		-- Branch version number
-		-- This is the "pending" version of data
-		branch_version_id integer default 1);
-	''')
-	# Create a unique index for sites on site_id
-	con.execute('''
-	CREATE UNIQUE INDEX IF NOT EXISTS idx_sites ON sites(site_id);
-	''')
-	# Create a table to store changelog entries
-	con.execute('''
-	CREATE TABLE IF NOT EXISTS site_changes(
-		site_id integer not null,
-		version_id integer not null,
-		description text not null,
-		is_publish integer not null default false,
-		created_at timestamp default current_timestamp);
-	''')
-	# Create a index for site_changes on site_id and version_id
-	con.execute('''
-	CREATE INDEX IF NOT EXISTS idx_changelogs ON site_changes(site_id, version_id);
-	''')
-	# Create a table to store item option data and fills
-	con.execute('''
-	CREATE TABLE IF NOT EXISTS site_options(
-		-- Lookup columns
-		-- ROWID is automatic in SQLite
-		site_id integer not null,    -- Not fillable
-		version_id integer not null, -- Not fillable
-		brand text not null,         -- Fill value = *
-		pn text not null,            -- Fill value = *
-		dp_id integer not null,      -- Fill value = 0
-		-- Data columns, these need to be nullable for our fill scheme to work
-		-- SQLite doesn't have boolean types
-		on_site integer);
-	''')
-	# Create a unique index over the lookup values. 
-	# This allows the insert-or-replace commands to work and ensure fills don't overlap.
-	con.execute('''
-	CREATE UNIQUE INDEX IF NOT EXISTS idx_site_options ON site_options(site_id, version_id, brand, pn, dp_id);
-	''')
-	con.commit()
+	con.executescript(SQL_CREATE_TABLES)
+
+# Size of the per-connection compiled statement cache kept by sqlite3
+# Besides the fixed statements, each fill predicate and fill level combination and each batched fetch size is its own statement,
+# so this leaves room for those without evicting the hot fetch/store statements.
+STATEMENT_CACHE_SIZE = 256
+
+# Most options fetch_site_option keeps cached on a connection, the least recently used are dropped past this
+SITE_OPTION_CACHE_SIZE = 100_000
+
+# Ask SQLite for a number that changes whenever another connection commits to the database
+SQL_GET_DATA_VERSION = "PRAGMA data_version"
+
+# Connection class used by open_db, which carries that connection's caches of site versions, fill levels and fetched options
+# The caches live on the connection so another database with the same site_id never sees them, and are dropped whenever
+# another connection has committed to the same database, see check_site_caches.
+class SiteConnection(sqlite3.Connection):
+	def __init__(self, database, *args, **kwargs):
+		super().__init__(database, *args, **kwargs)
+		# No other connection can commit to a private in-memory database, so its caches never need checking
+		self.shared = database != ':memory:'
+		# The data_version the caches were last checked against
+		self.data_version = None
+		# Trunk and branch versions keyed on site_id
+		self.trunk_version_cache = {}
+		self.branch_version_cache = {}
+		# FILL_* levels keyed on site_id
+		self.site_fill_levels_cache = {}
+		# Options keyed on (site_id, trunk_version_id, brand, pn, dp_id), least recently used first
+		self.site_option_cache = OrderedDict()
+		self.site_option_cache_size = SITE_OPTION_CACHE_SIZE
+
+# Drop a connection's caches if another connection has committed to the database since they were last checked
+# Reads outside a transaction check on every call, see get_site_trunk_version. transaction() checks once it has
+# the write lock, after which nothing else can commit until it's done.
+def check_site_caches(con):
+	if not con.shared:
+		return
+	data_version = con.execute(SQL_GET_DATA_VERSION).fetchone()[0]
+	if data_version != con.data_version:
+		invalidate_site_versions(con)
+		invalidate_site_fill_levels(con)
+		invalidate_site_options(con)
+		con.data_version = data_version
+
+# Open a database connection with the connection settings and schema set up
+# Defaults to an in-memory database, pass a file path for a database that persists
+# The helpers below keep their caches on the connection, so they need a connection opened here.
+# The connection is in autocommit mode (isolation_level=None), writes are grouped with transaction() instead of
+# sqlite3 opening an implicit transaction before each statement.
+def open_db(path=':memory:'):
+	con = sqlite3.connect(path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE, factory=SiteConnection)
+	configure_connection(con)
+	create_tables(con)
+	return con
+
+# Copy a database to a file on disk with SQLite's online backup, replacing whatever the file held before
+# Lets a run work entirely in memory and only pay for the disk writes once at the end.
+def save_db(con, path):
+	disk = sqlite3.connect(path)
+	try:
+		con.backup(disk)
+	finally:
+		disk.close()
+
+# Close a database connection opened with open_db, letting SQLite refresh its planner statistics first
+def close_db(con):
+	con.execute(SQL_OPTIMIZE)
+	con.close()
+
+# Run a block of writes as a single transaction, committing when the block finishes
+# BEGIN IMMEDIATE takes the write lock up front, so the transaction can't fail to upgrade from a read lock part way through.
+# If the block or the commit raises, the cached site versions, fill levels and options are dropped and the transaction is rolled back,
+# since a create or publish in the block will have already moved them on.
+@contextmanager
+def transaction(con):
+	con.execute("BEGIN IMMEDIATE")
+	try:
+		check_site_caches(con)
+		yield con
+		con.execute("COMMIT")
+	except BaseException:
+		# Drop the caches first, so they're cleared even if the rollback fails
+		invalidate_site_versions(con)
+		invalidate_site_fill_levels(con)
+		invalidate_site_options(con)
+		# SQLite rolls back by itself on some errors (e.g. SQLITE_FULL, SQLITE_IOERR), and a second ROLLBACK
+		# would raise over the original exception
+		if con.in_transaction:
+			con.execute("ROLLBACK")
+		raise
 
 # Helper method to get a human-readable description for a change to a site option
-def get_change_desc_for_site_option(brand, pn, dp_id, on_site):
-	is_fill = brand is None or pn is None or dp_id is None
+# The caller says whether the change is a fill, since it has already worked that out
+# Each part is worked out on its own and the description is put together with one f-string, rather than concatenating as we go
+def get_change_desc_for_site_option(brand, pn, dp_id, on_site, is_fill):
 	action = "Fill" if is_fill else "Set"
-
-	desc = f"{action}"
-	if brand:
-		desc = desc + f" {brand}"
-	if pn:
-		desc = desc + f":{pn}"
-	if dp_id:
-		desc = desc + f" option {dp_id}"
-	desc = desc + f" on_site={on_site}"
-	return desc
+	brand = f" {brand}" if brand else ""
+	pn = f":{pn}" if pn else ""
+	dp_id = f" option {dp_id}" if dp_id else ""
+	return f"{action}{brand}{pn}{dp_id} on_site={on_site}"
 
 # Store a site option or fill into the database
+# NOTE: The write helpers don't commit. Callers group them into one transaction with `with transaction(con):`,
+# so a whole version's worth of changes costs a single commit.
 def store_site_option(con, site_id, brand, pn, dp_id, on_site):
 	# First, check that the site_id is valid
 	assert site_id is not None
-	# First, get the branch version. Ideally this would be cached before hand to eliminate the extra query.
+	# First, get the branch version. This comes from the cache after the first lookup for the site.
 	# NOTE: We always store to the branch (cms) version. 
 	branch_version_id = get_site_branch_version(con, site_id)
+	# A null in any fillable column signals a fill
+	is_fill = brand is None or pn is None or dp_id is None
 	# Get the description before we mess with the parameters
-	desc = get_change_desc_for_site_option(brand, pn, dp_id, on_site)
+	desc = get_change_desc_for_site_option(brand, pn, dp_id, on_site, is_fill)
 
 	# If the row is a fill, first "delete" any rows that the fill would affect
-	if brand is None or pn is None or dp_id is None :
-		params = { "site_id": site_id, "branch_version_id": branch_version_id, "brand": brand, "pn": pn, "dp_id":dp_id }
-
-		# Build a string to match predicates specified in the parameters
-		predicates = "site_id=:site_id AND version_id<=:branch_version_id"
-		if brand:
-			predicates = predicates + " AND brand=:brand"
-		if pn:
-			predicates = predicates + " AND pn=:pn"
-		if dp_id:
-			predicates = predicates + " AND dp_id=:dp_id"
-
-		con.execute(f'''
-		INSERT OR REPLACE INTO site_options(version_id, site_id, brand, pn, dp_id, on_site) 
-		SELECT :branch_version_id, a.site_id, a.brand, a.pn, a.dp_id, null
-		FROM site_options a
-		INNER JOIN (
-			SELECT MAX(version_id) as version_id, site_id, brand, pn, dp_id
-			FROM site_options
-			WHERE {predicates}
-			GROUP BY site_id, brand, pn, dp_id
-		) b
-		ON a.site_id=b.site_id AND a.version_id=b.version_id AND a.brand=b.brand AND a.pn=b.pn AND a.dp_id=a.dp_id;
-		''', params)
-
-	# Validate any fillable columns, swap them with their fill values if they are null (signaling a fill)
-	brand = brand if brand is not None else '*'
-	pn = pn if pn is not None else '*'
-	dp_id = dp_id if dp_id is not None else 0
-	# Insert the row
-	params = { 
-		"site_id": site_id, "version_id": branch_version_id,
-		"brand": brand, "pn": pn, "dp_id": dp_id, 
-		"on_site": on_site
-	}
-	con.execute('''
-	INSERT OR REPLACE INTO site_options(site_id, version_id, brand, pn, dp_id, on_site) 
-	VALUES (:site_id, :version_id, :brand, :pn, :dp_id, :on_site); 
-	''', params)
+	if is_fill:
+		# Only the brand/pn/dp_id values that are set are matched on, the statement for that combination is picked to suit
+		params = [branch_version_id, site_id]
+		params.extend(value for value in (brand, pn, dp_id) if value)
+		con.execute(SQL_FILL_SITE_OPTIONS_BY_KEYS[bool(brand), bool(pn), bool(dp_id)], params)
+
+		# Swap the null fillable columns with their fill values
+		brand, pn, dp_id = (
+			brand if brand is not None else '*',
+			pn if pn is not None else '*',
+			dp_id if dp_id is not None else 0,
+		)
+	# Insert the row, on_site is always stored as 0/1 so reads can just use bool()
+	con.execute(SQL_STORE_SITE_OPTION, (site_id, branch_version_id, brand, pn, dp_id, int(bool(on_site))))
+	add_site_fill_level(con, site_id, brand, pn, dp_id)
 	# Insert a changelog entry for the change
-	con.execute('''
-	INSERT INTO site_changes(site_id, version_id, description) 
-	VALUES (:site_id, :version_id, :desc)
-	''', {"site_id": site_id, "version_id": branch_version_id, "desc": desc})
-	# Execute the transaction
-	con.commit()
+	con.execute(SQL_STORE_SITE_CHANGE, (site_id, branch_version_id, desc))
+
+# Store a batch of site options or fills into the database
+# Each row is a (brand, pn, dp_id, on_site) tuple, same as the store_site_option parameters
+# Runs in the caller's transaction like store_site_option
+def store_site_options(con, site_id, rows):
+	# First, check that the site_id is valid
+	assert site_id is not None
+	# Get the branch version once for the whole batch
+	branch_version_id = get_site_branch_version(con, site_id)
+	pending = []
+	for brand, pn, dp_id, on_site in rows:
+		if brand is None or pn is None or dp_id is None:
+			# A fill needs to see every row stored before it, so flush what we have and store it on its own
+			insert_site_option_rows(con, site_id, branch_version_id, pending)
+			pending = []
+			store_site_option(con, site_id, brand, pn, dp_id, on_site)
+		else:
+			pending.append((brand, pn, dp_id, on_site))
+	insert_site_option_rows(con, site_id, branch_version_id, pending)
+
+# Bulk insert non-fill site option rows and their changelog entries for a version
+def insert_site_option_rows(con, site_id, version_id, rows):
+	if not rows:
+		return
+	con.executemany(SQL_STORE_SITE_OPTION, [
+		(site_id, version_id, brand, pn, dp_id, int(bool(on_site))) for brand, pn, dp_id, on_site in rows
+	])
+	# A plain row given fill values (e.g. dp_id=0) is looked up as a fill, so it counts towards the site's fill levels
+	for brand, pn, dp_id, _ in rows:
+		add_site_fill_level(con, site_id, brand, pn, dp_id)
+	con.executemany(SQL_STORE_SITE_CHANGE, [
+		(site_id, version_id, get_change_desc_for_site_option(brand, pn, dp_id, on_site, False)) for brand, pn, dp_id, on_site in rows
+	])
+
+# Row factory for the many-fetch query, building the SiteOption as sqlite3 reads each row
+# This is set on the fetch cursor only, the other queries still get plain tuples
+def site_option_row_factory(cursor, row):
+	return SiteOption(row[0], row[1], row[2], row[3], row[4], bool(row[5]))
 
 # Fetch a single site option from the database
+# Options already fetched at the site's trunk version are returned from the connection's cache without a query
 def fetch_site_option(con, site_id, brand, pn, dp_id):
 	# First, check that the site_id is valid
 	assert site_id is not None
-	# Get the trunk version. Ideally this would be cached before hand to eliminate the extra query.
+	# Get the trunk version. This comes from the cache after the first lookup for the site.
 	# NOTE: We always fetch from the trunk (live) version. 
 	trunk_version_id = get_site_trunk_version(con, site_id)
-	params = { "site_id": site_id, "version_id": trunk_version_id, "brand": brand, "pn": pn, "dp_id": dp_id }
-	# Use a coalesce'd select query to get the data for the site option, taking into account fills
-	# Q: Why use ORDER BY version_id DESC LIMIT 1 instead of MAX(version_id)? 
-	# A: This is done because the trunk version won't actually be the highest version_id, the branch version will. 
-	# And ORDER BY/LIMIT isn't actually that slow in my testing, provided the version_id is indexed
-	query = con.execute('''
-	WITH _fill_tbl(site_id, version_id, brand, pn, dp_id, on_site) AS (VALUES (
-		:site_id, :version_id, :brand, :pn, :dp_id,
-		-- Query most specific to least specific, looking for a result 
-		COALESCE(
-			-- Item specific check
-			(SELECT on_site FROM site_options WHERE site_id=:site_id AND version_id<=:version_id AND brand=:brand AND pn=:pn   AND dp_id=:dp_id ORDER BY version_id DESC LIMIT 1),
-			-- Fill for all options on item (site-specific)
-			(SELECT on_site FROM site_options WHERE site_id=:site_id AND version_id<=:version_id AND brand=:brand AND pn=:pn   AND dp_id=0 ORDER BY version_id DESC LIMIT 1),
-			-- FIll for all items in brand (site-specific)
-			(SELECT on_site FROM site_options WHERE site_id=:site_id AND version_id<=:version_id AND brand=:brand AND pn=\'*\' AND dp_id=0 ORDER BY version_id DESC LIMIT 1),
-			-- Default fill value for the site
-			(SELECT on_site FROM site_options WHERE site_id=:site_id AND version_id<=:version_id AND brand=\'*\'  AND pn=\'*\' AND dp_id=0 ORDER BY version_id DESC LIMIT 1),
-			-- Default fallback value
-			TRUE)
-	))
-	SELECT * FROM _fill_tbl;
-	''', params);
-	# Fetch the result and convert
-	result = query.fetchone()
-	if result:
-		return SiteOption(result[0], result[1], result[2], result[3], result[4], (result[5] == 1))
-	return None
+	# The trunk version is part of the key, so a publish moves fetches on to new entries and the old ones age out
+	cache = con.site_option_cache
+	key = (site_id, trunk_version_id, brand, pn, dp_id)
+	option = cache.get(key)
+	if option is not None:
+		cache.move_to_end(key)
+		return option
+	# Only probe the fill levels the site has, this also comes from a cache after the first lookup.
+	fill_levels = get_site_fill_levels(con, site_id)
+	# The query only returns the resolved on_site value, the rest of the option is what we looked up
+	on_site = con.execute(SQL_FETCH_SITE_OPTION_BY_FILLS[fill_levels], (site_id, brand, pn, dp_id)).fetchone()[0]
+	option = SiteOption(site_id, trunk_version_id, brand, pn, dp_id, bool(on_site))
+	cache[key] = option
+	if len(cache) > con.site_option_cache_size:
+		cache.popitem(last=False)
+	return option
 
-# Create a site entry with default values
+# The connection caches the trunk and branch versions for each site_id, so reads and writes don't need to query the sites table every call
+# The versions only change when a site is created or published, which keep the caches up to date
+
+# Drop the cached versions for a site (or all sites if no site_id is given), the next lookup reads them from the database
+# Needed when a transaction that created or published a site is rolled back, since the caches were updated ahead of the commit
+def invalidate_site_versions(con, site_id=None):
+	if site_id is None:
+		con.trunk_version_cache.clear()
+		con.branch_version_cache.clear()
+	else:
+		con.trunk_version_cache.pop(site_id, None)
+		con.branch_version_cache.pop(site_id, None)
+
+# Drop the options fetch_site_option has cached on a connection
+# Needed when versions are reused: a rolled back publish, or a site re-created at version 0
+def invalidate_site_options(con):
+	con.site_option_cache.clear()
+
+# The connection caches the FILL_* levels each site has ever stored, so fetches can leave out the probes for levels it doesn't have
+
+# Drop the cached fill levels, the next lookup reads them from the database
+def invalidate_site_fill_levels(con):
+	con.site_fill_levels_cache.clear()
+
+# Get the FILL_* levels the site has ever stored, only querying the database if they aren't cached yet
+def get_site_fill_levels(con, site_id):
+	fill_levels = con.site_fill_levels_cache.get(site_id)
+	if fill_levels is not None:
+		return fill_levels
+	result = con.execute(SQL_GET_SITE_FILL_LEVELS, (site_id,)).fetchone()
+	assert(result is not None)
+	con.site_fill_levels_cache[site_id] = result[0]
+	return result[0]
+
+# Get the FILL_* level a stored row is looked up at, 0 for an item specific value
+def get_fill_level_for_site_option(brand, pn, dp_id):
+	if pn == '*':
+		return FILL_SITE if brand == '*' else FILL_BRAND
+	return FILL_ITEM if dp_id == 0 else 0
+
+# Add the fill level of a row just stored to the site's levels, in the caller's transaction
+# The sites row is only written the first time the site stores a fill at that level
+def add_site_fill_level(con, site_id, brand, pn, dp_id):
+	fill_level = get_fill_level_for_site_option(brand, pn, dp_id)
+	if fill_level and not fill_level & get_site_fill_levels(con, site_id):
+		con.execute(SQL_ADD_SITE_FILL_LEVEL, (fill_level, site_id))
+		con.site_fill_levels_cache[site_id] |= fill_level
+
+# Split keys into batches for the batched fetches, yielding each batch with the FETCH_BATCH_SIZES entry to pad it out to
+def get_fetch_batches(keys):
+	batch_size = FETCH_BATCH_SIZES[-1]
+	for start in range(0, len(keys), batch_size):
+		batch = keys[start:start + batch_size]
+		yield next(size for size in FETCH_BATCH_SIZES if size >= len(batch)), batch
+
+# Fetch several site options on the same item from the database, a batch of dp_ids per query
+# Returns a dict of dp_id to SiteOption
+def fetch_site_options_many(con, site_id, brand, pn, dp_ids):
+	# First, check that the site_id is valid
+	assert site_id is not None
+	if not dp_ids:
+		return {}
+	# NOTE: We always fetch from the trunk (live) version. 
+	trunk_version_id = get_site_trunk_version(con, site_id)
+	cursor = con.cursor()
+	cursor.row_factory = site_option_row_factory
+	options = {}
+	for size, batch in get_fetch_batches(dp_ids):
+		# The padding dp_ids are never looked at, the query skips them by their number
+		padding = [None] * (size - len(batch))
+		cursor.execute(SQL_FETCH_SITE_OPTIONS_MANY_BY_SIZE[size], (site_id, trunk_version_id, brand, pn, len(batch), *batch, *padding))
+		# Fetch the results, the row factory converts them
+		options.update((option.dp_id, option) for option in cursor)
+	return options
+
+# Fetch site options for several items from the database, a batch of keys per query
+# Takes a list of (brand, pn, dp_id) keys, returns a dict of key to SiteOption
+# Binding the keys costs more than a few separate fetches save, so this is for fetching a good number of items at once.
+def fetch_site_options_bulk(con, site_id, keys):
+	# First, check that the site_id is valid
+	assert site_id is not None
+	if not keys:
+		return {}
+	# NOTE: We always fetch from the trunk (live) version. 
+	trunk_version_id = get_site_trunk_version(con, site_id)
+	options = {}
+	for size, batch in get_fetch_batches(keys):
+		params = [site_id, len(batch)]
+		for key in batch:
+			params.extend(key)
+		# The padding keys are never looked at, the query skips them by their number
+		params.extend([None] * (3 * (size - len(batch))))
+		for brand, pn, dp_id, on_site in con.execute(SQL_FETCH_SITE_OPTIONS_BULK_BY_SIZE[size], params):
+			options[(brand, pn, dp_id)] = SiteOption(site_id, trunk_version_id, brand, pn, dp_id, bool(on_site))
+	return options
+
+# Create a site entry with default values, in the caller's transaction
 def create_site(con, site_id):
-	params = { "site_id": site_id }
-	con.execute('''
-	INSERT OR REPLACE INTO sites(site_id, trunk_version_id, branch_version_id) VALUES (:site_id, 0, 1); 
-	''', params)
-	con.commit()
+	con.execute(SQL_CREATE_SITE, (site_id,))
+	# Re-creating a site resets it to trunk version 0, so any values it had published are no longer live
+	con.execute(SQL_CLEAR_CURRENT_SITE_OPTIONS, (site_id,))
+	con.trunk_version_cache[site_id] = 0
+	con.branch_version_cache[site_id] = 1
+	# Its versions start again from 0, so options cached at those versions are out of date
+	invalidate_site_options(con)
 
-# Get the trunk ID for the site
+# Get the trunk ID for the site, only querying the database if it isn't cached yet
+# Every fetch starts here, so outside a transaction this is where the connection's caches are checked
 def get_site_trunk_version(con, site_id):
-	query  = con.execute('''SELECT trunk_version_id FROM sites WHERE site_id=:site_id''', { "site_id": site_id })
+	if not con.in_transaction:
+		check_site_caches(con)
+	trunk_version_id = con.trunk_version_cache.get(site_id)
+	if trunk_version_id is not None:
+		return trunk_version_id
+	query  = con.execute(SQL_GET_SITE_TRUNK_VERSION, (site_id,))
 	result = query.fetchone()
 	assert(result is not None)
+	con.trunk_version_cache[site_id] = result[0]
 	return result[0]
 
-# Get the branch ID for the site
+# Get the branch ID for the site, only querying the database if it isn't cached yet
 def get_site_branch_version(con, site_id):
-	query  = con.execute('''SELECT branch_version_id FROM sites WHERE site_id=:site_id''', { "site_id": site_id })
+	if not con.in_transaction:
+		check_site_caches(con)
+	branch_version_id = con.branch_version_cache.get(site_id)
+	if branch_version_id is not None:
+		return branch_version_id
+	query  = con.execute(SQL_GET_SITE_BRANCH_VERSION, (site_id,))
 	result = query.fetchone()
 	assert(result is not None)
+	con.branch_version_cache[site_id] = result[0]
 	return result[0]
 
 # Print the change log entries for a version to the std out
 def print_changelog_for_version(con, site_id, version_id):
 	# Get changelog entries for version
-	params = { "site_id": site_id, "version_id": version_id }
-	query = con.execute('''
-	SELECT * FROM site_changes WHERE site_id=:site_id AND version_id=:version_id;
-	''', params)
-	rows = query.fetchall()
-	# Pretty print
+	query = con.execute(SQL_GET_CHANGELOG, (site_id, version_id))
+	# Pretty print, reading the rows from the cursor as we go rather than building a list of them first
 	print(f"Changelog for version #{version_id}:")
-	if not rows:
+	empty = True
+	for created_at, description in query:
+		empty = False
+		print(f"[{created_at}] {description}")
+	if empty:
 		print("\tEmpty")
-	for row in rows:
-		print(f"[{row[4]}] {row[2]}")
 
 # Publish the current branch changes to the trunk
+# Runs in the caller's transaction, usually the same one as the stores being published
 def publish_site(con, site_id, desc=None):
-	# First, get the branch version. Ideally this would be cached before hand to eliminate the extra query. 
+	# First, get the branch version. This comes from the cache after the first lookup for the site.
 	branch_version_id = get_site_branch_version(con, site_id)
 	# Get the description for the publish if none was provided
 	desc = desc if desc else f"Publish changes for version #{branch_version_id}"
 	# Swap the trunk version for the branch version, increment the branch version
-	params = { "site_id": site_id }
-	con.execute('''
-	UPDATE sites SET 
-		trunk_version_id =branch_version_id, 
-		branch_version_id=branch_version_id+1 
-	WHERE site_id=:site_id;
-	''', params)
+	con.execute(SQL_PUBLISH_SITE, (branch_version_id, branch_version_id + 1, site_id))
+	con.trunk_version_cache[site_id] = branch_version_id
+	con.branch_version_cache[site_id] = branch_version_id + 1
+	# Apply the published changes to the live values
+	con.execute(SQL_UPDATE_CURRENT_SITE_OPTIONS, (site_id, branch_version_id))
+	con.execute(SQL_DELETE_CURRENT_SITE_OPTIONS, (site_id, branch_version_id))
 	# Insert a changelog entry for the change
-	con.execute('''
-	INSERT INTO site_changes(site_id, version_id, description, is_publish) 
-	VALUES (:site_id, :version_id, :desc, true)
-	''', {"site_id": site_id, "version_id": branch_version_id, "desc": desc})
-	con.commit()
+	con.execute(SQL_STORE_PUBLISH_CHANGE, (site_id, branch_version_id, desc))
 
 # Rollback the site data to a prior version
+# This publishes the rolled back data, in the caller's transaction
 def rollback_site(con, site_id, to_version_id):
-	# First, get the branch version. Ideally this would be cached before hand to eliminate the extra query.
+	# First, get the branch version. This comes from the cache after the first lookup for the site.
 	# NOTE: We always store to the branch (cms) version. 
 	branch_version_id = get_site_branch_version(con, site_id)
-	params = { "site_id": site_id, "to_version_id": to_version_id, "branch_version_id": branch_version_id }
-	# Clear out any pending changes. 
-	# This needs to be done since all "rolled back" data is added to the branch version before being published.
-	con.execute('''
-	DELETE FROM site_options WHERE version_id=:branch_version_id;
-	''', params)
-	# Copy the rows that existed at the selected version, with the current branch version as the version_id
-	# This makes a more recent copy of the data that existed at the point we're rolling back to
-	con.execute('''
-	INSERT INTO site_options(version_id, site_id, brand, pn, dp_id, on_site) 
-	SELECT :branch_version_id, a.site_id, a.brand, a.pn, a.dp_id, a.on_site 
-	FROM site_options a
-	INNER JOIN (
-		SELECT MAX(version_id) as version_id, site_id, brand, pn, dp_id 
-		FROM site_options 
-		WHERE version_id<=:to_version_id AND site_id=:site_id
-		GROUP BY brand, pn, dp_id
-	) b
-	ON a.brand=b.brand AND a.pn=b.pn AND a.dp_id=b.dp_id AND a.version_id=b.version_id;
-	''', params)
-	# Get the items that don't exist in the new version, and insert them with the branch version_id and null data values
-	# This effectively "deletes" any rows that shouldn't exist at the version we're rolling back to. 
+	# Copy the data that existed at the selected version into the branch version, in a single pass over the site's items
+	# This makes a more recent copy of the data that existed at the point we're rolling back to.
+	# Items that shouldn't exist at that version are written as deleted rows rather than having their rows removed.
 	# We don't actually want to delete any data, since that would make it impossible to rollback to previous points after this rollback
-	con.execute('''
-	WITH _tmp_tble_items_to_delete(version_id, site_id, brand, pn, dp_id) AS
-	(
-		SELECT MAX(version_id) as version_id, site_id, brand, pn, dp_id
-			FROM site_options 
-			WHERE version_id<=:branch_version_id AND site_id=:site_id
-			GROUP BY brand, pn, dp_id
-		EXCEPT
-		SELECT version_id, site_id, brand, pn, dp_id
-			FROM site_options
-			WHERE version_id=:branch_version_id AND site_id=:site_id
-	)
-	INSERT INTO site_options(version_id, site_id, brand, pn, dp_id, on_site) 
-	SELECT :branch_version_id, site_id, brand, pn, dp_id, NULL FROM _tmp_tble_items_to_delete;
-	''', params)
+	con.execute(SQL_ROLLBACK_SITE, (site_id, to_version_id, branch_version_id))
 	# Create a description for the publish
 	desc = f"Rolled back site settings to version #{to_version_id}"
 	# Publish branch
-	# NOTE: This is where the transaction is committed to keep database consistency
 	publish_site(con, site_id, desc)
+	# A rollback can copy a lot of rows, keep the planner statistics from going stale for the fetches
+	con.execute(SQL_OPTIMIZE)
 
 # Assertion helper for testing
 def assert_match(site_option, version_id, on_site):
 	assert site_option.version_id == version_id, f'version_id is {site_option.version_id}, should be {version_id}'
 	assert site_option.on_site == on_site, f'on_site is {site_option.on_site}, should be {on_site}'
+# Assertion helper for testing several items at once, fetching them all with a single query
+# Takes a list of ((brand, pn, dp_id), version_id, on_site) cases
+def assert_match_many(con, site_id, cases):
+	options = fetch_site_options_bulk(con, site_id, [key for key, _, _ in cases])
+	for key, version_id, on_site in cases:
+		assert_match(options[key], version_id, on_site)
 # Test cases to ensure correctness of algorithm
 def run_tests(con):
 	# Set up some test data
@@ -292,28 +744,46 @@ def run_tests(con):
 	brand   = "ASHLEY"
 	pns     = ["000111", "000112", "000113"]
 	dp_ids  = [1000001, 1000002, 1000003]
+	# Items checked after each version, fetched together by assert_match_many
+	keys    = [
+		(brand, pns[0], dp_ids[0]),
+		(brand, pns[0], dp_ids[1]),
+		(brand, pns[0], dp_ids[2]),
+		(brand, pns[1], dp_ids[2]),
+		(brand, pns[2], dp_ids[2]),
+	]
 
 	print("Create the site")
-	create_site(con, site_id)
+	with transaction(con):
+		create_site(con, site_id)
 
 	print("Store version 1")
-	store_site_option(con, site_id, brand, pns[0], dp_ids[0], True) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[0], dp_ids[1], True) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[0], dp_ids[2], True) # Store a specific value 
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], dp_ids[0], True), # Store a specific value
+			(brand, pns[0], dp_ids[1], True), # Store a specific value
+			(brand, pns[0], dp_ids[2], True), # Store a specific value
+		])
+		publish_site(con, site_id)
 
 	print_changelog_for_version(con, site_id, 1)
 
 	print("Store version 2")
-	store_site_option(con, site_id, brand, pns[0], dp_ids[1], False) # Store a specific value 
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], dp_ids[1], False), # Store a specific value
+		])
+		publish_site(con, site_id)
 
 	print_changelog_for_version(con, site_id, 2)
 
 	print("Store version 3")
-	store_site_option(con, site_id, brand, pns[0], dp_ids[0], False) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[1], None, False)      # Store a fill on_site=false over the item ASHLEY:000112
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], dp_ids[0], False), # Store a specific value
+			(brand, pns[1], None, False),      # Store a fill on_site=false over the item ASHLEY:000112
+		])
+		publish_site(con, site_id)
 	
 	print_changelog_for_version(con, site_id, 3)
 
@@ -325,106 +795,264 @@ def run_tests(con):
 	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 3, True)  # Version should be 3, on_site=True, Value taken from default
 
 	print("Rollback to a prior version (version 2 as version 4)")
-	rollback_site(con, site_id, 2)
+	with transaction(con):
+		rollback_site(con, site_id, 2)
 
 	print_changelog_for_version(con, site_id, 4)
 
 	print("Get the current version (version 4, but actually version 2)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 4, True)  # Version should be 4, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 4, False) # Version should be 4, on_site=False
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 4, True)  # Version should be 4, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 4, True)  # Version should be 4, on_site=True, Value take from default
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 4, True)  # Version should be 4, on_site=True, Value taken from default
+	assert_match_many(con, site_id, [
+		(keys[0], 4, True),  # Version should be 4, on_site=True
+		(keys[1], 4, False), # Version should be 4, on_site=False
+		(keys[2], 4, True),  # Version should be 4, on_site=True
+		(keys[3], 4, True),  # Version should be 4, on_site=True, Value take from default
+		(keys[4], 4, True),  # Version should be 4, on_site=True, Value taken from default
+	])
 
 	print("Store version 5")
-	store_site_option(con, site_id, brand, pns[0], dp_ids[0], True) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[0], dp_ids[1], True) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[0], dp_ids[2], True) # Store a specific value 
-	store_site_option(con, site_id, brand, pns[2], None, False)     # Store a fill on_site=false over the item ASHLEY:000112
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], dp_ids[0], True), # Store a specific value
+			(brand, pns[0], dp_ids[1], True), # Store a specific value
+			(brand, pns[0], dp_ids[2], True), # Store a specific value
+			(brand, pns[2], None, False),     # Store a fill on_site=false over the item ASHLEY:000112
+		])
+		publish_site(con, site_id)
 
 	print_changelog_for_version(con, site_id, 5)
 
 	print("Get the current version (version 5)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 5, True)  # Version should be 5, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 5, True)  # Version should be 5, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 5, True)  # Version should be 5, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 5, True)  # Version should be 5, on_site=True, Value take from default
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 5, False) # Version should be 5, on_site=False, Value taken from fill
+	assert_match_many(con, site_id, [
+		(keys[0], 5, True),  # Version should be 5, on_site=True
+		(keys[1], 5, True),  # Version should be 5, on_site=True
+		(keys[2], 5, True),  # Version should be 5, on_site=True
+		(keys[3], 5, True),  # Version should be 5, on_site=True, Value take from default
+		(keys[4], 5, False), # Version should be 5, on_site=False, Value taken from fill
+	])
 
 	print("Rollback to a prior version (version 3 as version 6)")
-	rollback_site(con, site_id, 3)
+	with transaction(con):
+		rollback_site(con, site_id, 3)
 
 	print_changelog_for_version(con, site_id, 6)
 
 	print("Get the current version (version 6, but actually version 3)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 6, False) # Version should be 6, on_site=False
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 6, False) # Version should be 6, on_site=False
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 6, True)  # Version should be 6, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 6, False) # Version should be 6, on_site=False, Value take from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 6, True)  # Version should be 6, on_site=True, Value taken from default
+	assert_match_many(con, site_id, [
+		(keys[0], 6, False), # Version should be 6, on_site=False
+		(keys[1], 6, False), # Version should be 6, on_site=False
+		(keys[2], 6, True),  # Version should be 6, on_site=True
+		(keys[3], 6, False), # Version should be 6, on_site=False, Value take from fill over item
+		(keys[4], 6, True),  # Version should be 6, on_site=True, Value taken from default
+	])
 
 	print("Store version 7")
-	store_site_option(con, site_id, brand, pns[0], None, False) # Store a fill on_site=false over the item ASHLEY:000112
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], None, False), # Store a fill on_site=false over the item ASHLEY:000112
+		])
+		publish_site(con, site_id)
 
 	print("Get the current version (version 7)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 7, False) # Version should be 7, on_site=False, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 7, False) # Version should be 7, on_site=False, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 7, False) # Version should be 7, on_site=False, value taken from fill over item
+	options = fetch_site_options_many(con, site_id, brand, pns[0], dp_ids)
+	assert_match(options[dp_ids[0]], 7, False) # Version should be 7, on_site=False, value taken from fill over item
+	assert_match(options[dp_ids[1]], 7, False) # Version should be 7, on_site=False, value taken from fill over item
+	assert_match(options[dp_ids[2]], 7, False) # Version should be 7, on_site=False, value taken from fill over item
 	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 7, False) # Version should be 7, on_site=False, Value take from fill over item
 	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 7, True)  # Version should be 7, on_site=True, Value taken from default
 
 	print("Store version 8")
-	store_site_option(con, site_id, brand, pns[0], None, True) # Store a fill on_site=true over the item ASHLEY:000112
-	publish_site(con, site_id)
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[0], None, True), # Store a fill on_site=true over the item ASHLEY:000112
+		])
+		publish_site(con, site_id)
 
 	print_changelog_for_version(con, site_id, 8)
 
 	print("Get the current version (version 8)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 8, True)  # Version should be 8, on_site=True, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 8, True)  # Version should be 8, on_site=True, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 8, True)  # Version should be 8, on_site=True, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 8, False) # Version should be 8, on_site=False, Value take from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 8, True)  # Version should be 8, on_site=True, Value taken from default
+	assert_match_many(con, site_id, [
+		(keys[0], 8, True),  # Version should be 8, on_site=True, value taken from fill over item
+		(keys[1], 8, True),  # Version should be 8, on_site=True, value taken from fill over item
+		(keys[2], 8, True),  # Version should be 8, on_site=True, value taken from fill over item
+		(keys[3], 8, False), # Version should be 8, on_site=False, Value take from fill over item
+		(keys[4], 8, True),  # Version should be 8, on_site=True, Value taken from default
+	])
 	
-	print("Rollback to a prior version (version 7 as version 9)")
-	rollback_site(con, site_id, 7)
+	print("Rollback to a prior version (version 7 as version 9), discarding a pending change")
+	with transaction(con):
+		store_site_options(con, site_id, [
+			(brand, pns[2], dp_ids[2], False), # Pending change to an item with no prior value, the rollback should discard it
+		])
+		rollback_site(con, site_id, 7)
 
 	print("Get the current version (version 7, but actually version 9)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 9, False) # Version should be 9, on_site=False, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 9, False) # Version should be 9, on_site=False, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 9, False) # Version should be 9, on_site=False, value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 9, False) # Version should be 9, on_site=False, Value take from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 9, True)  # Version should be 9, on_site=True, Value taken from default
+	assert_match_many(con, site_id, [
+		(keys[0], 9, False), # Version should be 9, on_site=False, value taken from fill over item
+		(keys[1], 9, False), # Version should be 9, on_site=False, value taken from fill over item
+		(keys[2], 9, False), # Version should be 9, on_site=False, value taken from fill over item
+		(keys[3], 9, False), # Version should be 9, on_site=False, Value take from fill over item
+		(keys[4], 9, True),  # Version should be 9, on_site=True, Value taken from default
+	])
 
 	print("Rollback to a prior version (version 3 as version 10)")
-	rollback_site(con, site_id, 3)
+	with transaction(con):
+		rollback_site(con, site_id, 3)
 
 	print_changelog_for_version(con, site_id, 10)
 
 	print("Get the current version (version 3 as version 10)")
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 10, False) # Version should be 10, on_site=False
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[1]), 10, False) # Version should be 10, on_site=False
-	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[2]), 10, True)  # Version should be 10, on_site=True
-	assert_match(fetch_site_option(con, site_id, brand, pns[1], dp_ids[2]), 10, False) # Version should be 10, on_site=False, Value taken from fill over item
-	assert_match(fetch_site_option(con, site_id, brand, pns[2], dp_ids[2]), 10, True)  # Version should be 10, on_site=True, Value taken from default
+	assert_match_many(con, site_id, [
+		(keys[0], 10, False), # Version should be 10, on_site=False
+		(keys[1], 10, False), # Version should be 10, on_site=False
+		(keys[2], 10, True),  # Version should be 10, on_site=True
+		(keys[3], 10, False), # Version should be 10, on_site=False, Value taken from fill over item
+		(keys[4], 10, True),  # Version should be 10, on_site=True, Value taken from default
+	])
+
+	print("Abort a publish part way through (version 11 is never published)")
+	try:
+		with transaction(con):
+			publish_site(con, site_id)
+			# Fetch inside the transaction, so the option is cached at a version that is never committed
+			assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 11, False) # Version should be 11, on_site=False
+			raise RuntimeError("Abort publish")
+	except RuntimeError:
+		# The transaction was rolled back, which drops the cached versions too
+		pass
+	trunk_version_id = get_site_trunk_version(con, site_id)
+	branch_version_id = get_site_branch_version(con, site_id)
+	assert trunk_version_id == 10, f'trunk_version_id is {trunk_version_id}, should be 10'
+	assert branch_version_id == 11, f'branch_version_id is {branch_version_id}, should be 11'
+	assert_match(fetch_site_option(con, site_id, brand, pns[0], dp_ids[0]), 10, False) # Version should be 10, the cached version 11 option was dropped
+
+	print("Abort a publish SQLite has already rolled back (version 11 is never published)")
+	try:
+		with transaction(con):
+			publish_site(con, site_id)
+			# Stand in for an error that makes SQLite roll back the transaction itself
+			con.execute("ROLLBACK")
+			raise RuntimeError("Abort publish")
+	except RuntimeError:
+		# The original error comes through, not one from rolling back a second time
+		pass
+	trunk_version_id = get_site_trunk_version(con, site_id)
+	branch_version_id = get_site_branch_version(con, site_id)
+	assert trunk_version_id == 10, f'trunk_version_id is {trunk_version_id}, should be 10'
+	assert branch_version_id == 11, f'branch_version_id is {branch_version_id}, should be 11'
+
+	print("Re-create a site that has published values")
+	with transaction(con):
+		create_site(con, site_id + 1)
+		store_site_options(con, site_id + 1, [
+			(brand, pns[0], dp_ids[0], False), # Store a specific value
+		])
+		publish_site(con, site_id + 1)
+	assert_match(fetch_site_option(con, site_id + 1, brand, pns[0], dp_ids[0]), 1, False) # Version should be 1, on_site=False
+	with transaction(con):
+		create_site(con, site_id + 1)
+	assert_match(fetch_site_option(con, site_id + 1, brand, pns[0], dp_ids[0]), 0, True)  # Version should be 0, on_site=True, nothing is published yet
+
+	print("Add brand and site default fills to a site that had none")
+	with transaction(con):
+		create_site(con, site_id + 2)
+		store_site_options(con, site_id + 2, [
+			(brand, pns[0], dp_ids[0], True), # Store a specific value
+		])
+		publish_site(con, site_id + 2)
+	assert_match(fetch_site_option(con, site_id + 2, brand, pns[1], dp_ids[0]), 1, True)  # Version should be 1, on_site=True, Value taken from default
+	with transaction(con):
+		store_site_options(con, site_id + 2, [
+			(brand, None, None, False), # Store a fill on_site=false over the brand ASHLEY
+		])
+		publish_site(con, site_id + 2)
+	assert_match(fetch_site_option(con, site_id + 2, brand, pns[1], dp_ids[0]), 2, False)   # Version should be 2, on_site=False, Value taken from fill over brand
+	assert_match(fetch_site_option(con, site_id + 2, "OTHER", pns[1], dp_ids[0]), 2, True)  # Version should be 2, on_site=True, Value taken from default
+	with transaction(con):
+		store_site_options(con, site_id + 2, [
+			(None, None, None, False), # Store a default fill on_site=false for the site
+		])
+		publish_site(con, site_id + 2)
+	assert_match(fetch_site_option(con, site_id + 2, "OTHER", pns[1], dp_ids[0]), 3, False) # Version should be 3, on_site=False, Value taken from site default fill
+	assert_match(fetch_site_option(con, site_id + 2, brand, pns[0], dp_ids[0]), 3, False)   # Version should be 3, on_site=False, Value taken from site default fill
+	# The levels were written to the sites row as they were stored, and re-creating the site keeps them
+	with transaction(con):
+		create_site(con, site_id + 2)
+	invalidate_site_fill_levels(con)
+	fill_levels = get_site_fill_levels(con, site_id + 2)
+	assert fill_levels == FILL_BRAND | FILL_SITE, f'fill_levels is {fill_levels}, should be {FILL_BRAND | FILL_SITE}'
+
+	print("Fetch more items than fit in one bulk batch")
+	# A key with no brand is still looked up, falling through to the site's fills
+	bulk_keys = keys + [(None, pns[0], dp_ids[0])] + [(brand, pns[i % len(pns)], i) for i in range(FETCH_BATCH_SIZES[-1])]
+	options = fetch_site_options_bulk(con, site_id, bulk_keys)
+	assert len(options) == len(bulk_keys), f'fetched {len(options)} options, should be {len(bulk_keys)}'
+	for key in bulk_keys:
+		option = fetch_site_option(con, site_id, *key)
+		assert_match(options[key], option.version_id, option.on_site) # Should match fetching the item on its own
+	many_dp_ids = list(range(1, FETCH_BATCH_SIZES[-1] + 2)) + dp_ids
+	options = fetch_site_options_many(con, site_id, brand, pns[0], many_dp_ids)
+	assert len(options) == len(many_dp_ids), f'fetched {len(options)} options, should be {len(many_dp_ids)}'
+	for dp_id in many_dp_ids:
+		option = fetch_site_option(con, site_id, brand, pns[0], dp_id)
+		assert_match(options[dp_id], option.version_id, option.on_site) # Should match fetching the item on its own
+
+	print("Drop the least recently used options past the cache size")
+	con.site_option_cache_size = 2
+	invalidate_site_options(con)
+	fetch_site_option(con, site_id, *keys[0])
+	fetch_site_option(con, site_id, *keys[1])
+	fetch_site_option(con, site_id, *keys[0]) # Fetching keys[0] again makes keys[1] the least recently used
+	fetch_site_option(con, site_id, *keys[2])
+	cached = [key[2:] for key in con.site_option_cache]
+	assert cached == [keys[0], keys[2]], f'cached options are {cached}, should be {[keys[0], keys[2]]}'
+	con.site_option_cache_size = SITE_OPTION_CACHE_SIZE
+
+	print("Fetch from a second connection while the first publishes")
+	with tempfile.TemporaryDirectory() as path:
+		writer = open_db(os.path.join(path, 'shared.db'))
+		reader = open_db(os.path.join(path, 'shared.db'))
+		with transaction(writer):
+			create_site(writer, site_id)
+			store_site_options(writer, site_id, [
+				(brand, pns[0], dp_ids[0], True), # Store a specific value
+			])
+			publish_site(writer, site_id)
+		assert_match(fetch_site_option(reader, site_id, brand, pns[0], dp_ids[0]), 1, True)      # Version should be 1, on_site=True
+		with transaction(writer):
+			store_site_options(writer, site_id, [
+				(brand, pns[0], dp_ids[0], False), # Store a specific value
+			])
+			publish_site(writer, site_id)
+			# The reader still sees version 1 until the publish is committed
+			assert_match(fetch_site_option(reader, site_id, brand, pns[0], dp_ids[0]), 1, True)  # Version should be 1, on_site=True
+		assert_match(fetch_site_option(reader, site_id, brand, pns[0], dp_ids[0]), 2, False)     # Version should be 2, on_site=False
+		try:
+			with transaction(writer):
+				store_site_options(writer, site_id, [
+					(brand, pns[0], dp_ids[0], True), # Store a specific value
+				])
+				publish_site(writer, site_id)
+				assert_match(fetch_site_option(reader, site_id, brand, pns[0], dp_ids[0]), 2, False) # Version should be 2, on_site=False
+				raise RuntimeError("Abort publish")
+		except RuntimeError:
+			pass
+		assert_match(fetch_site_option(reader, site_id, brand, pns[0], dp_ids[0]), 2, False)     # Version should be 2, the publish was rolled back
+		assert_match(fetch_site_option(writer, site_id, brand, pns[0], dp_ids[0]), 2, False)     # Version should be 2, the publish was rolled back
+		close_db(reader)
+		close_db(writer)
 
 	# All done
 	print("All tests passed!")
 
 def main():
-	# Delete the old database before creating a new one
-	if os.path.exists('wf.db'):
-		os.remove('wf.db')
-	# Open the SQL database connection
-	con = sqlite3.connect('wf.db')
-	# Make sure we have the schema set up
-	create_tables(con)
+	# Open an in-memory database, so the tests don't touch the disk while they run
+	con = open_db()
 	# Run test cases
 	run_tests(con)
+	# Save the final state to wf.db so it can be inspected afterwards
+	save_db(con, 'wf.db')
 	# Close the database connection
-	con.close()
+	close_db(con)
 
 if __name__ == '__main__':
 	main()